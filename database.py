@@ -1,24 +1,130 @@
 import sqlite3
 import os
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
 
 # Store DB in the hoard directory for easier container persistence
 os.makedirs("hoard", exist_ok=True)
 DB_PATH = os.path.join("hoard", "hoard.db")
+READER_POOL_SIZE = os.cpu_count() or 4
 
 class Database:
+    """
+    One writer connection (serialized by a lock) plus a pool of read-only
+    connections, so reads never queue behind a write in progress.
+    """
+
+    # Kept as constants so repeated calls hit sqlite3's prepared-statement cache
+    _SQL_ADD_ARTIST = """
+        INSERT OR IGNORE INTO artists (name, source, favorite, probability_weight, last_checked, last_checked_ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+        RETURNING id
+    """
+    _SQL_ADD_ARTISTS = "INSERT OR IGNORE INTO artists (name, source) VALUES (?, ?)"
+    _SQL_UPDATE_ARTIST = """
+        UPDATE artists
+        SET last_checked = ?, last_checked_ts = ?, last_scraped_post = ?, probability_weight = ?
+        WHERE id = ?
+    """
+    # Highest id images ever handed out (AUTOINCREMENT keeps it up to date,
+    # explicit ids included), so ids of deleted images are never reused
+    _SQL_LAST_IMAGE_ID = "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'images'), 0)"
+    _SQL_INSERT_IMAGE = """
+        INSERT INTO images (id, artist_id, source, post_id, hash, timestamp, shard_file, offset, size)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    # Fills in a reservation made by reserve_hash; an existing entry is kept
+    _SQL_INSERT_HASH = """
+        INSERT INTO hash_index (hash, image_id)
+        VALUES (?, ?)
+        ON CONFLICT(hash) DO UPDATE SET image_id = excluded.image_id
+        WHERE image_id IS NULL
+    """
+    _SQL_RESERVE_HASH = """
+        INSERT INTO hash_index (hash, image_id)
+        VALUES (?, NULL)
+        ON CONFLICT(hash) DO NOTHING
+        RETURNING hash
+    """
+    _SQL_CLAIM_SHARD = """
+        INSERT INTO storage_meta (source, current_shard)
+        VALUES (?, ?)
+        ON CONFLICT(source) DO UPDATE SET current_shard = current_shard + 1
+        RETURNING current_shard
+    """
+
     def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
         self.conn = None
         self.cursor = None
+        self._write_lock = threading.Lock()
+        self._readers = queue.Queue()
         self.connect()
         self.init_db()
+        self._open_readers()
+
+    def _configure(self, conn):
+        conn.row_factory = sqlite3.Row
+        # Generous timeout: the scheduler and viewer run as separate processes
+        conn.execute("PRAGMA busy_timeout=60000")
+        conn.execute("PRAGMA cache_size=-65536")  # 64 MB per connection
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
 
     def connect(self):
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        # Autocommit mode: transactions are opened explicitly by write()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        self._configure(self.conn)
         self.cursor = self.conn.cursor()
 
+        # Only takes effect on a new, empty database (before the first table)
+        self.cursor.execute("PRAGMA page_size=4096")
+
+        # WAL lets the viewer read while the scraper/scheduler write, and
+        # synchronous=NORMAL only fsyncs at checkpoints instead of every commit
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA foreign_keys=ON")
+        # Keep a flush transaction's dirty pages in the page cache until
+        # COMMIT instead of spilling them to the file (and locking it) midway
+        self.cursor.execute("PRAGMA cache_spill=OFF")
+
+    def _open_readers(self):
+        # Opened after init_db so the file exists for mode=ro
+        uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        for _ in range(READER_POOL_SIZE):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None, cached_statements=256)
+            self._configure(conn)
+            self._readers.put(conn)
+
+    @contextmanager
+    def read(self):
+        """Checks out a read-only connection and yields a cursor on it."""
+        conn = self._readers.get()
+        try:
+            yield conn.cursor()
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        """
+        Yields the writer cursor inside a BEGIN IMMEDIATE transaction.
+        Commits on success, rolls back on error.
+        """
+        with self._write_lock:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.cursor
+            except BaseException:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+
     def init_db(self):
         # 1. artists
         self.cursor.execute("""
@@ -30,10 +136,22 @@ class Database:
                 last_scraped_post TEXT,
                 avg_upload_interval_hours REAL DEFAULT 24.0,
                 probability_weight REAL DEFAULT 1.0,
-                last_checked DATETIME
+                last_checked DATETIME,
+                last_checked_ts INTEGER
             )
         """)
 
+        # Older databases only have the DATETIME column; add the epoch one and
+        # backfill it (last_checked was written as local time)
+        self.cursor.execute("PRAGMA table_info(artists)")
+        if "last_checked_ts" not in [col['name'] for col in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE artists ADD COLUMN last_checked_ts INTEGER")
+            self.cursor.execute("""
+                UPDATE artists
+                SET last_checked_ts = CAST(strftime('%s', last_checked, 'utc') AS INTEGER)
+                WHERE last_checked IS NOT NULL
+            """)
+
         # 2. images
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS images (
@@ -58,36 +176,140 @@ class Database:
                 FOREIGN KEY(image_id) REFERENCES images(id)
             )
         """)
+
+        # 4. storage_meta: the shard each source is writing to, so storage
+        # doesn't have to list the shard directory to find the next index
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS storage_meta (
+                source TEXT PRIMARY KEY,
+                current_shard INTEGER
+            )
+        """)
+
+        # 5. indexes for the hot lookups (artist by name, images by artist, latest images)
+        try:
+            self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_artists_name ON artists(name)")
+        except sqlite3.IntegrityError:
+            # Databases created before names were unique may hold duplicates
+            print("Duplicate artist names found; creating non-unique name index")
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_artists_name ON artists(name)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_artist ON images(artist_id, timestamp DESC)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_timestamp ON images(timestamp DESC)")
         
         self.conn.commit()
 
     def add_artist(self, name, source='danbooru', favorite=False):
         try:
             # Set last_checked to NULL so it gets picked up immediately by the scheduler
-            self.cursor.execute("""
-                INSERT INTO artists (name, source, favorite, probability_weight, last_checked)
-                VALUES (?, ?, ?, ?, ?)
-            """, (name, source, favorite, 10.0 if favorite else 1.0, None))
-            self.conn.commit()
-            return self.cursor.lastrowid
+            with self.write() as cursor:
+                cursor.execute(self._SQL_ADD_ARTIST, (name, source, favorite, 10.0 if favorite else 1.0, None, None))
+                row = cursor.fetchone()
+                if row is None:
+                    # Already exists; the unique name index made the insert a no-op
+                    cursor.execute("SELECT id FROM artists WHERE name = ?", (name,))
+                    row = cursor.fetchone()
+                return row[0]
         except sqlite3.Error as e:
             print(f"Error adding artist {name}: {e}")
             return None
 
+    def add_artists(self, rows):
+        """
+        Inserts (name, source) rows in one transaction, skipping names that
+        already exist. Returns the number of artists added.
+        """
+        with self.write() as cursor:
+            cursor.executemany(self._SQL_ADD_ARTISTS, rows)
+            return cursor.rowcount
+
+    def update_artists(self, updates):
+        """Applies (last_checked, last_checked_ts, last_scraped_post, probability_weight, id) rows in one transaction."""
+        with self.write() as cursor:
+            cursor.executemany(self._SQL_UPDATE_ARTIST, updates)
+
+    def record_flushes(self, flush_results):
+        """
+        Inserts the images of each ParquetStorage flush result and their
+        hash_index entries, all in one transaction.
+        """
+        with self.write() as cursor:
+            for result in flush_results:
+                rows = result['rows']
+
+                # Ids are assigned up front (safe under BEGIN IMMEDIATE) so both
+                # tables can be filled with executemany instead of row by row
+                cursor.execute(self._SQL_LAST_IMAGE_ID)
+                base_id = cursor.fetchone()[0] + 1
+
+                cursor.executemany(self._SQL_INSERT_IMAGE, [
+                    (base_id + i, row['artist_id'], row['source'], row['post_id'], row['hash'],
+                     row['timestamp'], result['shard_file'], result['start_offset'] + i, row['size'])
+                    for i, row in enumerate(rows)
+                ])
+                cursor.executemany(self._SQL_INSERT_HASH, [(row['hash'], base_id + i) for i, row in enumerate(rows)])
+
+    def reserve_hash(self, image_hash):
+        """
+        Claims image_hash in hash_index before the image is stored. Returns
+        False if the hash was already there (a duplicate). The image id is
+        filled in when the image's flush is recorded.
+        """
+        with self.write() as cursor:
+            cursor.execute(self._SQL_RESERVE_HASH, (image_hash,))
+            return cursor.fetchone() is not None
+
+    def clear_hash_reservations(self):
+        """Drops reservations whose image never got recorded (e.g. after a crash)."""
+        with self.write() as cursor:
+            cursor.execute("DELETE FROM hash_index WHERE image_id IS NULL")
+
+    def claim_shard(self, source, first_index=0):
+        """
+        Reserves the next shard index for source and returns it. first_index
+        is used when the source has no storage_meta row yet.
+        """
+        with self.write() as cursor:
+            cursor.execute(self._SQL_CLAIM_SHARD, (source, first_index))
+            return cursor.fetchone()[0]
+
+    def get_storage_meta(self, source):
+        with self.read() as cursor:
+            cursor.execute("SELECT current_shard FROM storage_meta WHERE source = ?", (source,))
+            return cursor.fetchone()
+
     def get_artist_by_name(self, name):
-        self.cursor.execute("SELECT * FROM artists WHERE name = ?", (name,))
-        return self.cursor.fetchone()
+        with self.read() as cursor:
+            cursor.execute("SELECT * FROM artists WHERE name = ?", (name,))
+            return cursor.fetchone()
 
     def get_all_artists(self):
-        self.cursor.execute("SELECT * FROM artists")
-        return self.cursor.fetchall()
+        with self.read() as cursor:
+            cursor.execute("SELECT * FROM artists")
+            return cursor.fetchall()
+
+    def get_post_ids(self, artist_id, source='danbooru'):
+        # Served by idx_images_artist; source is checked on the matched rows
+        with self.read() as cursor:
+            cursor.execute("SELECT post_id FROM images WHERE artist_id = ? AND source = ?", (artist_id, source))
+            return {row[0] for row in cursor.fetchall()}
+
+    def get_max_artist_id(self):
+        # Artists are never deleted, so this changes exactly when one is added
+        with self.read() as cursor:
+            cursor.execute("SELECT MAX(id) FROM artists")
+            return cursor.fetchone()[0]
 
     def get_pending_count(self):
-        self.cursor.execute("SELECT COUNT(*) FROM artists WHERE last_checked IS NULL")
-        return self.cursor.fetchone()[0]
+        with self.read() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM artists WHERE last_checked_ts IS NULL")
+            return cursor.fetchone()[0]
 
     def close(self):
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
         if self.conn:
+            # Refreshes planner statistics (sqlite_stat1) for tables that need it
+            self.conn.execute("PRAGMA optimize")
             self.conn.close()
 
 if __name__ == "__main__":
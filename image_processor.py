@@ -1,85 +1,169 @@
 import os
-import io
-import imagehash
-from PIL import Image
+import numpy as np
 
 # Add libvips to PATH before importing pyvips
 vipshome = r'C:\Users\darlis\Downloads\vips-dev-w64-web-8.17.3-static-ffi\vips-dev-8.17\bin'
 if os.path.exists(vipshome):
     os.environ['PATH'] = vipshome + ';' + os.environ['PATH']
 
+# Images are processed in parallel by the scraper's worker pool, so one libvips
+# thread per image avoids ncpu x ncpu threads fighting over the cores.
+# Must be set before libvips starts; an explicit environment value wins.
+os.environ.setdefault('VIPS_CONCURRENCY', '1')
+
 import pyvips
 
+# Every image is seen once, so libvips' operation cache only holds memory
+pyvips.cache_set_max(0)
+
 # Configuration
 MAX_DIMENSION = 850
 WEBP_QUALITY_MAX = 75
 WEBP_QUALITY_MIN = 70
+QUALITY_RATIO_LOW = 1.3  # At or below this aspect ratio use WEBP_QUALITY_MAX
+QUALITY_RATIO_HIGH = 1.7  # At or above this aspect ratio use WEBP_QUALITY_MIN
+WEBP_EFFORT = 2  # 0-6; 6 is several times slower to encode for a few % smaller files
+WEBP_EFFORT_FALLBACK = 4  # Retried with this if an encode at WEBP_EFFORT fails
+# Downloaded WebPs at most this many bytes per pixel are stored as-is; denser
+# ones were saved at a higher quality than ours, so re-encoding them pays off
+WEB_READY_MAX_BYTES_PER_PIXEL = 0.2
+
+# Perceptual hash (same algorithm as imagehash.phash): DCT of a 32x32 greyscale
+# thumbnail, keep the 8x8 low frequencies, threshold against their median.
+# libvips resamples differently from PIL, so hashes stored by imagehash differ
+# (often by 4-8 bits); run rehash_images.py once on an existing hoard.
+HASH_SIZE = 8
+HASH_HIGHFREQ_FACTOR = 4
+_DCT_SIZE = HASH_SIZE * HASH_HIGHFREQ_FACTOR
+
+def _dct_matrix(n):
+    # Unnormalized DCT-II basis, equivalent to scipy.fftpack.dct(type=2)
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return 2 * np.cos(np.pi * k * (2 * i + 1) / (2 * n))
+
+# Only the low-frequency rows are ever kept, so the transform is
+# (8x32) @ (32x32) @ (32x8) instead of two full 32x32 products
+_DCT_LOW = _dct_matrix(_DCT_SIZE)[:HASH_SIZE]
+
+def _webp_quality(width, height):
+    """Lower quality for elongated images, interpolating between the two ratio thresholds."""
+    aspect_ratio = max(width, height) / min(width, height) if min(width, height) > 0 else 1
+
+    if aspect_ratio <= QUALITY_RATIO_LOW:
+        return WEBP_QUALITY_MAX
+    if aspect_ratio >= QUALITY_RATIO_HIGH:
+        return WEBP_QUALITY_MIN
+    progress = (aspect_ratio - QUALITY_RATIO_LOW) / (QUALITY_RATIO_HIGH - QUALITY_RATIO_LOW)
+    return int(WEBP_QUALITY_MAX - (progress * (WEBP_QUALITY_MAX - WEBP_QUALITY_MIN)))
+
+def _load_header(image_bytes):
+    # Header-only load for format and dimensions; no pixels are decoded here.
+    # A Source reads any buffer (bytes, memoryview) in place without copying it.
+    return pyvips.Image.new_from_source(pyvips.Source.new_from_memory(image_bytes), "", access='sequential')
+
+def _is_web_ready(image_bytes, header):
+    """
+    True for a simple-format lossy WebP (a lone 'VP8 ' chunk: one frame, no
+    alpha, no ICC profile or EXIF/XMP) already at or below MAX_DIMENSION on
+    the short side and WEB_READY_MAX_BYTES_PER_PIXEL. Lossless and extended
+    WebPs always go through _encode.
+    """
+    riff = bytes(image_bytes[:16])
+    if riff[:4] != b'RIFF' or riff[8:12] != b'WEBP' or riff[12:16] != b'VP8 ':
+        return False
+    if min(header.width, header.height) > MAX_DIMENSION:
+        return False
+    return len(image_bytes) <= header.width * header.height * WEB_READY_MAX_BYTES_PER_PIXEL
+
+def _compress(image_bytes):
+    header = _load_header(image_bytes)
+    if _is_web_ready(image_bytes, header):
+        # Decided from the header alone, so no pixels are decoded or encoded;
+        # copied, since the caller may reuse its buffer
+        return bytes(image_bytes)
+    return _encode(_resize(image_bytes, header))
+
+def _resize(image_bytes, header):
+    """Shrinks image bytes (any buffer) to MAX_DIMENSION on the short side."""
+    # Determine resize targets
+    if header.width > header.height:
+        # Landscape
+        target_width = 10000000
+        target_height = MAX_DIMENSION
+    else:
+        # Portrait or Square
+        target_width = MAX_DIMENSION
+        target_height = 10000000
+
+    # Load and resize in one step so the loader can shrink-on-load
+    # (JPEG DCT scaling, WebP scaled decode) instead of decoding full size
+    return pyvips.Image.thumbnail_source(
+        pyvips.Source.new_from_memory(image_bytes),
+        target_width,
+        height=target_height,
+        size='down',
+        export_profile='srgb'
+    )
+
+def _encode(thumb):
+    # Calculate adaptive quality
+    q_value = _webp_quality(thumb.width, thumb.height)
+
+    # Save to buffer
+    try:
+        return thumb.write_to_buffer(".webp", Q=q_value, strip=True, effort=WEBP_EFFORT, smart_subsample=True)
+    except pyvips.Error:
+        return thumb.write_to_buffer(".webp", Q=q_value, strip=True, effort=WEBP_EFFORT_FALLBACK, smart_subsample=True)
 
 def process_image_bytes(image_bytes):
     """
-    Resizes and compresses image bytes using libvips.
+    Resizes and compresses image bytes (any buffer) using libvips.
     Returns compressed bytes (WebP).
     """
     try:
-        # Load image from memory
-        image = pyvips.Image.new_from_buffer(image_bytes, "")
-
-        # Determine resize targets
-        if image.width > image.height:
-            # Landscape
-            target_width = 10000000
-            target_height = MAX_DIMENSION
-        else:
-            # Portrait or Square
-            target_width = MAX_DIMENSION
-            target_height = 10000000
-
-        # Resize
-        thumb = image.thumbnail_image(
-            target_width,
-            height=target_height,
-            size='down',
-            export_profile='srgb'
-        )
-
-        # Calculate adaptive quality
-        w = thumb.width
-        h = thumb.height
-        aspect_ratio = max(w, h) / min(w, h) if min(w, h) > 0 else 1
-
-        ratio_threshold_low = 1.3
-        ratio_threshold_high = 1.7
-        
-        if aspect_ratio <= ratio_threshold_low:
-            q_value = WEBP_QUALITY_MAX
-        elif aspect_ratio >= ratio_threshold_high:
-            q_value = WEBP_QUALITY_MIN
-        else:
-            progress = (aspect_ratio - ratio_threshold_low) / (ratio_threshold_high - ratio_threshold_low)
-            q_value = int(WEBP_QUALITY_MAX - (progress * (WEBP_QUALITY_MAX - WEBP_QUALITY_MIN)))
-
-        # Save to buffer
-        output_buffer = thumb.write_to_buffer(
-            ".webp",
-            Q=q_value,
-            strip=True,
-            effort=6,
-            smart_subsample=True
-        )
-        
-        return output_buffer
-
+        return _compress(image_bytes)
     except Exception as e:
         print(f"Error processing image: {e}")
         return None
 
+def _phash(small):
+    """
+    Hashes a _DCT_SIZE x _DCT_SIZE pyvips image. Returns a 16-char hex string.
+    """
+    grey = small.colourspace('b-w')[0].cast('uchar')  # [0] drops any alpha band
+    pixels = np.ndarray(
+        buffer=grey.write_to_memory(), dtype=np.uint8, shape=(_DCT_SIZE, _DCT_SIZE)
+    ).astype(np.float64)
+
+    low_freq = _DCT_LOW @ pixels @ _DCT_LOW.T
+    return np.packbits(low_freq > np.median(low_freq)).tobytes().hex()
+
+def _hash_buffer(image_bytes):
+    # Shrink-on-load straight to the hash size; no full-size decode
+    small = pyvips.Image.thumbnail_buffer(image_bytes, _DCT_SIZE, height=_DCT_SIZE, size='force')
+    return _phash(small)
+
 def calculate_hash(image_bytes):
     """
     Calculates perceptual hash of the image.
     """
     try:
-        image = Image.open(io.BytesIO(image_bytes))
-        return str(imagehash.phash(image))
+        return _hash_buffer(image_bytes)
     except Exception as e:
         print(f"Error calculating hash: {e}")
         return None
+
+def process_and_hash(image_bytes):
+    """
+    Resizes, compresses and hashes image bytes in one executor job.
+    Returns (compressed bytes, hash), or (None, None) on failure.
+    """
+    try:
+        compressed = _compress(image_bytes)
+        # Hashed from the stored WebP, so calculate_hash on a shard's bytes
+        # (see rehash_images.py) gives back exactly the stored hash
+        return compressed, _hash_buffer(compressed)
+    except Exception as e:
+        print(f"Error processing image: {e}")
+        return None, None
@@ -1,18 +1,26 @@
 import os
-import pandas as pd
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import io
 from PIL import Image
 
 PARQUET_DIR = os.path.join("hoard", "parquet")
 
+def _shard_entries(directory):
+    """Yields a DirEntry for every .parquet file under directory (shards live in per-source subdirectories)."""
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir():
+                yield from _shard_entries(entry.path)
+            elif entry.name.endswith(".parquet"):
+                yield entry
+
 def inspect_parquet():
     if not os.path.exists(PARQUET_DIR):
         print(f"Directory {PARQUET_DIR} does not exist.")
         return
 
-    files = [f for f in os.listdir(PARQUET_DIR) if f.endswith(".parquet")]
-    files.sort()
+    files = sorted(_shard_entries(PARQUET_DIR), key=lambda entry: entry.path)
 
     if not files:
         print("No parquet files found.")
@@ -24,31 +32,31 @@ def inspect_parquet():
     print(f"{'Filename':<30} | {'Rows':<6} | {'Size (MB)':<10} | {'Avg Img (KB)':<12}")
     print("-" * 70)
 
-    for f in files:
-        path = os.path.join(PARQUET_DIR, f)
-        file_size_mb = os.path.getsize(path) / (1024 * 1024)
+    for entry in files:
+        path = entry.path
+        f = os.path.relpath(path, PARQUET_DIR).replace("\\", "/")
+        file_size_mb = entry.stat().st_size / (1024 * 1024)
         total_size += file_size_mb
         
         try:
-            table = pq.read_table(path)
-            df = table.to_pandas()
-            row_count = len(df)
+            # Row count comes from the footer; only the small 'size' column is read
+            pf = pq.ParquetFile(path)
+            row_count = pf.metadata.num_rows
             total_images += row_count
             
             # Calculate average image size
             avg_img_size_kb = 0
             if row_count > 0:
-                # sum of length of bytes in image_bytes column
-                total_bytes = df['image_bytes'].apply(len).sum()
+                total_bytes = pc.sum(pf.read(columns=['size']).column('size')).as_py()
                 avg_img_size_kb = (total_bytes / row_count) / 1024
 
             print(f"{f:<30} | {row_count:<6} | {file_size_mb:<10.2f} | {avg_img_size_kb:<12.2f}")
 
             # Inspect first image dimensions
             if row_count > 0:
-                first_img_bytes = df.iloc[0]['image_bytes']
-                img = Image.open(io.BytesIO(first_img_bytes))
-                print(f"   > Sample Image 1: {img.format} {img.size} (Artist ID: {df.iloc[0]['artist_id']})")
+                first = pf.read_row_group(0, columns=['image_bytes', 'artist_id']).slice(0, 1)
+                img = Image.open(io.BytesIO(first.column('image_bytes')[0].as_py()))
+                print(f"   > Sample Image 1: {img.format} {img.size} (Artist ID: {first.column('artist_id')[0].as_py()})")
 
         except Exception as e:
             print(f"{f:<30} | ERROR: {e}")
@@ -0,0 +1,47 @@
+import os
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow.parquet as pq
+from database import Database
+from image_processor import calculate_hash
+from storage import PARQUET_BASE_DIR
+
+WORKERS = os.cpu_count() or 4
+
+def rehash_images():
+    """
+    Recomputes every image's perceptual hash from its stored shard and rebuilds
+    hash_index from them. Needed once for hoards whose hashes came from
+    imagehash, which the current hash doesn't reproduce exactly. Run it with
+    the scraper stopped.
+    """
+    db = Database()
+    with db.read() as cursor:
+        cursor.execute("SELECT id, shard_file, offset FROM images ORDER BY shard_file, offset")
+        images = cursor.fetchall()
+
+    updates = []
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for shard_file, rows in itertools.groupby(images, key=lambda row: row[1]):
+            rows = list(rows)
+            path = os.path.join(PARQUET_BASE_DIR, shard_file)
+            if not os.path.exists(path):
+                print(f"Missing shard {shard_file}; keeping the old hashes of its {len(rows)} images")
+                continue
+
+            column = pq.read_table(path, columns=['image_bytes']).column('image_bytes')
+            hashes = pool.map(calculate_hash, (column[offset].as_py() for _, _, offset in rows))
+            updates.extend((image_hash, image_id) for (image_id, _, _), image_hash in zip(rows, hashes) if image_hash)
+            print(f"Rehashed {len(rows)} images from {shard_file}")
+
+    with db.write() as cursor:
+        cursor.executemany("UPDATE images SET hash = ? WHERE id = ?", updates)
+        # The oldest image keeps each hash, as when they were first recorded
+        cursor.execute("DELETE FROM hash_index")
+        cursor.execute("INSERT OR IGNORE INTO hash_index (hash, image_id) SELECT hash, id FROM images ORDER BY id")
+    db.close()
+
+    print(f"Rehashed {len(updates)} of {len(images)} images")
+
+if __name__ == "__main__":
+    rehash_images()
@@ -1,7 +1,9 @@
 import asyncio
-import random
 import logging
-from datetime import datetime, timedelta
+import signal
+import time
+import numpy as np
+from datetime import datetime
 from database import Database
 from scraper import AsyncScraper
 
@@ -9,107 +11,162 @@ from scraper import AsyncScraper
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Artist stat updates are written in batches to save a commit per artist
+UPDATE_BATCH_SIZE = 10
+UPDATE_FLUSH_SECONDS = 60
+
 class Scheduler:
     def __init__(self):
         self.db = Database()
         self.scraper = AsyncScraper()
         self.cooldown_minutes = 60  # Don't check the same artist twice in an hour
+        self._pending_updates = []  # (last_checked, last_checked_ts, last_scraped_post, probability_weight, id)
+        self._last_update_flush = time.monotonic()
+
+        # Cached artist rows with weights/last-checked as arrays for vectorized picks
+        self._rng = np.random.default_rng()
+        self._artists = None
+        self._max_artist_id = None
+        self._weights = None
+        self._last_checked = None
+        self._selected_idx = None
+
+    def flush_updates(self):
+        if not self._pending_updates:
+            return
+        self.db.update_artists(self._pending_updates)
+        self._pending_updates = []
+        self._last_update_flush = time.monotonic()
+
+    def _load_artists(self):
+        self._artists = [dict(a) for a in self.db.get_all_artists()]
+
+        # Queued updates aren't in the database yet (see _record_check);
+        # reapply them or the reload would undo them
+        by_id = {a['id']: a for a in self._artists}
+        for last_checked, last_checked_ts, last_scraped_post, weight, artist_id in self._pending_updates:
+            if artist_id in by_id:
+                by_id[artist_id].update(
+                    last_checked=last_checked,
+                    last_checked_ts=last_checked_ts,
+                    last_scraped_post=last_scraped_post,
+                    probability_weight=weight,
+                )
+
+        self._max_artist_id = self.db.get_max_artist_id()
+        self._weights = np.array([a['probability_weight'] for a in self._artists], dtype=np.float64)
+        self._last_checked = np.array([a['last_checked_ts'] or 0 for a in self._artists], dtype=np.int64)
 
     def select_artist(self):
-        artists = self.db.get_all_artists()
-        if not artists:
+        # Artists are cached and only reloaded when new ones are added;
+        # the scheduler's own updates are written through to the cache.
+        if self._artists is None or self.db.get_max_artist_id() != self._max_artist_id:
+            self._load_artists()
+
+        if not self._artists:
             return "empty"
-        
-        available_artists = []
-        for a in artists:
-            last_checked = a['last_checked']
-            if last_checked:
-                # Parse datetime string if necessary (SQLite stores as string)
-                if isinstance(last_checked, str):
-                    try:
-                        # Handle potential fractional seconds
-                        if "." in last_checked:
-                            last_checked = datetime.strptime(last_checked, "%Y-%m-%d %H:%M:%S.%f")
-                        else:
-                            last_checked = datetime.strptime(last_checked, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        # If parsing fails, assume it's old and needs checking
-                        last_checked = datetime.min
-
-                if datetime.now() - last_checked < timedelta(minutes=self.cooldown_minutes):
-                    continue
-            
-            available_artists.append(a)
-
-        if not available_artists:
+
+        available = int(time.time()) - self._last_checked >= self.cooldown_minutes * 60
+        if not available.any():
             return "cooldown"
-        
-        weights = [a['probability_weight'] for a in available_artists]
-        selected = random.choices(available_artists, weights=weights, k=1)[0]
-        return selected
+
+        cumulative = np.cumsum(np.where(available, self._weights, 0.0))
+        r = self._rng.random() * cumulative[-1]
+        idx = min(int(np.searchsorted(cumulative, r, side='right')), len(self._artists) - 1)
+        self._selected_idx = idx
+        return self._artists[idx]
+
+    def _record_check(self, artist, last_post, new_weight):
+        last_post = last_post or artist['last_scraped_post']
+        now = datetime.now()
+        now_ts = int(time.time())
+
+        artist['last_checked'] = now
+        artist['last_checked_ts'] = now_ts
+        artist['last_scraped_post'] = last_post
+        artist['probability_weight'] = new_weight
+        self._last_checked[self._selected_idx] = now_ts
+        self._weights[self._selected_idx] = new_weight
+
+        self._pending_updates.append((now, now_ts, last_post, new_weight, artist['id']))
+
+        # last_scraped_post must not reach the database before the images up
+        # to it are recorded (their shard finished), or a crash would lose them
+        if self.scraper.has_unrecorded_images():
+            return
+        if (len(self._pending_updates) >= UPDATE_BATCH_SIZE
+                or time.monotonic() - self._last_update_flush >= UPDATE_FLUSH_SECONDS):
+            self.flush_updates()
 
     async def run(self):
         logger.info("Starting Scheduler...")
-        
-        try:
-            while True:
-                artist = self.select_artist()
-                
-                if artist == "empty":
-                    logger.info("No artists found in database. Waiting for artists...")
-                    # Smart sleep: check every second for new artists
-                    for _ in range(60):
-                        if self.db.get_pending_count() > 0:
-                            logger.info("New artist detected! Waking up.")
-                            break
-                        await asyncio.sleep(1)
-                    continue
-                
-                if artist == "cooldown":
-                    logger.info("All artists are on cooldown. Waiting...")
-                    # Smart sleep: check every second for new artists
-                    for _ in range(60):
-                        if self.db.get_pending_count() > 0:
-                            logger.info("New artist detected! Waking up.")
-                            break
-                        await asyncio.sleep(1)
-                    continue
-
-                logger.info(f"Selected artist: {artist['name']} (Weight: {artist['probability_weight']})")
-                
-                # Scrape
-                last_post = await self.scraper.scrape_artist(
-                    artist['id'], 
-                    artist['name'], 
-                    artist['last_scraped_post']
-                )
 
-                # Update Stats
-                new_weight = artist['probability_weight']
-                if last_post and last_post != artist['last_scraped_post']:
-                    # Found new posts, increase weight
-                    new_weight = min(new_weight * 1.1, 100.0)
-                    logger.info(f"Found new posts. Increasing weight to {new_weight:.2f}")
-                else:
-                    # No new posts, decrease weight
-                    new_weight = max(new_weight * 0.9, 0.1)
-                    logger.info(f"No new posts. Decreasing weight to {new_weight:.2f}")
-
-                self.db.cursor.execute("""
-                    UPDATE artists 
-                    SET last_checked = ?, last_scraped_post = ?, probability_weight = ?
-                    WHERE id = ?
-                """, (datetime.now(), last_post or artist['last_scraped_post'], new_weight, artist['id']))
-                self.db.conn.commit()
-
-                # Sleep between artists to be polite
-                await asyncio.sleep(5)
-
-        except KeyboardInterrupt:
-            logger.info("Scheduler stopped by user.")
-        finally:
-            self.scraper.close()
-            self.db.close()
+        # docker stop sends SIGTERM, which Python ignores as PID 1; cancel the
+        # run instead so the finally below still finishes the open shard
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        # One HTTP session (connection pool, DNS cache) for the whole run
+        async with self.scraper:
+            try:
+                while True:
+                    artist = self.select_artist()
+
+                    if artist == "empty":
+                        logger.info("No artists found in database. Waiting for artists...")
+                        await self.scraper.finish_storage()
+                        self.flush_updates()
+                        # Smart sleep: check every second for new artists
+                        for _ in range(60):
+                            if self.db.get_pending_count() > 0:
+                                logger.info("New artist detected! Waking up.")
+                                break
+                            await asyncio.sleep(1)
+                        continue
+
+                    if artist == "cooldown":
+                        logger.info("All artists are on cooldown. Waiting...")
+                        await self.scraper.finish_storage()
+                        self.flush_updates()
+                        # Smart sleep: check every second for new artists
+                        for _ in range(60):
+                            if self.db.get_pending_count() > 0:
+                                logger.info("New artist detected! Waking up.")
+                                break
+                            await asyncio.sleep(1)
+                        continue
+
+                    logger.info(f"Selected artist: {artist['name']} (Weight: {artist['probability_weight']})")
+
+                    # Scrape
+                    last_post = await self.scraper.scrape_artist(
+                        artist['id'],
+                        artist['name'],
+                        artist['last_scraped_post']
+                    )
+
+                    # Update Stats
+                    new_weight = artist['probability_weight']
+                    if last_post and last_post != artist['last_scraped_post']:
+                        # Found new posts, increase weight
+                        new_weight = min(new_weight * 1.1, 100.0)
+                        logger.info(f"Found new posts. Increasing weight to {new_weight:.2f}")
+                    else:
+                        # No new posts, decrease weight
+                        new_weight = max(new_weight * 0.9, 0.1)
+                        logger.info(f"No new posts. Decreasing weight to {new_weight:.2f}")
+
+                    self._record_check(artist, last_post, new_weight)
+
+                    # Sleep between artists to be polite
+                    await asyncio.sleep(5)
+
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                logger.info("Scheduler stopped.")
+            finally:
+                # Finishes the shard first, so the updates are safe to write
+                self.scraper.close()
+                self.flush_updates()
+                self.db.close()
 
 if __name__ == "__main__":
     scheduler = Scheduler()
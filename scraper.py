@@ -1,12 +1,19 @@
 import asyncio
 import aiohttp
 import logging
+import os
+import random
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 from pybooru import Danbooru
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from database import Database
 from storage import ParquetStorage
-from image_processor import process_image_bytes, calculate_hash
-from datetime import datetime
+from image_processor import process_and_hash
+from datetime import datetime, timezone
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,46 +21,262 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 DEDUPLICATE_IMAGES = False  # Set to True to enable hash-based deduplication
+SKIP_EXISTING_POSTS = True  # Set to False to re-download posts already stored for the artist
+DOWNLOAD_CONCURRENCY = 5  # Max simultaneous connections to the image host
+RANGE_CHUNK_SIZE = 2 * 1024 * 1024  # Files larger than this are fetched as parallel ranges
+RANGE_MAX_PARTS = 8  # Max parallel range requests per file
+PAGE_LIMIT = 100  # Posts per metadata page (max for most boorus)
+PAGE_PREFETCH = 2  # Pages of posts queued ahead of the downloaders
+CPU_WORKERS = max(2, (os.cpu_count() or 2) - 1)  # Image decode/encode/hash threads
+BUFFER_SIZE_CLASSES = (1024 * 1024, 8 * 1024 * 1024)  # Reusable download buffer sizes
+BUFFER_POOL_PER_CLASS = DOWNLOAD_CONCURRENCY * 2  # Idle buffers kept per size class
+
+STREAM_CHUNK_SIZE = 256 * 1024  # Read size when streaming a response into its buffer
+MAX_PENDING_STORES = 32  # Compressed images waiting for the writer before downloads pause
+BACKOFF_MAX_SECONDS = 30  # Cap for exponential retry backoff
+RETRY_AFTER_MAX_SECONDS = 120  # Cap for server-provided Retry-After waits
+
+def _parse_retry_after(value):
+    """Retry-After is either delta-seconds or an HTTP date. Returns seconds or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _parse_content_range_total(content_range):
+    # "bytes 0-2097151/5242880" -> 5242880
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def _parse_content_range_start(content_range):
+    # "bytes 2097152-4194303/5242880" -> 2097152
+    return int(content_range.split()[1].split('-', 1)[0])
+
+async def _read_into(response, buffer, offset):
+    """Streams the response body into buffer at offset. Returns the end offset."""
+    with memoryview(buffer) as view:
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            end = offset + len(chunk)
+            if end > len(view):
+                raise ValueError(f"Response body overruns expected size {len(view)}")
+            view[offset:end] = chunk
+            offset = end
+    return offset
+
+def _log_store_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Error storing image: {future.exception()}")
+
+class BufferPool:
+    """
+    Reusable download buffers in fixed size classes, so each image doesn't
+    allocate (and free) a fresh multi-megabyte bytearray. Requests larger than
+    the biggest class get a one-off buffer. Only used from the event loop thread.
+    """
+    def __init__(self, size_classes=BUFFER_SIZE_CLASSES, per_class=BUFFER_POOL_PER_CLASS):
+        self._free = {size: [] for size in sorted(size_classes)}
+        self._per_class = per_class
+
+    def acquire(self, size):
+        for size_class, free in self._free.items():
+            if size <= size_class:
+                return free.pop() if free else bytearray(size_class)
+        return bytearray(size)
+
+    def release(self, buffer):
+        """Returns a buffer (or a memoryview over one) to the pool once nothing reads it."""
+        if isinstance(buffer, memoryview):
+            view, buffer = buffer, buffer.obj
+            view.release()
+        free = self._free.get(len(buffer)) if isinstance(buffer, bytearray) else None
+        if free is not None and len(free) < self._per_class:
+            free.append(buffer)
 
 class AsyncScraper:
     def __init__(self):
         self.db = Database()
-        self.storage = ParquetStorage()
+        self.storage = ParquetStorage(db=self.db)
         self.client = Danbooru('danbooru')
-        self.concurrency_limit = 5
-        self.semaphore = asyncio.Semaphore(self.concurrency_limit)
 
-    async def download_image(self, session, url, retries=5):
+        # Keep-alive pool for pybooru's metadata requests, with retries on
+        # rate limits / transient server errors (honours Retry-After)
+        retry = Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=retry)
+        self.client.client.mount('https://', adapter)
+        self.client.client.mount('http://', adapter)
+        # pybooru replaces the session's default headers, so restore this one
+        self.client.client.headers['Connection'] = 'keep-alive'
+        self.concurrency_limit = DOWNLOAD_CONCURRENCY
+
+        # The connector caps connections per host (this also bounds range
+        # requests), and keeps connections and DNS lookups warm
+        self._connector_kwargs = dict(limit=64, limit_per_host=self.concurrency_limit, ttl_dns_cache=300, keepalive_timeout=75)
+        self._timeout = aiohttp.ClientTimeout(total=60)
+        # Opened by __aenter__ and shared by every scrape_artist call
+        self.session = None
+
+        # host -> loop time before which no request should be sent, so one 429
+        # pauses every download to that host instead of each task finding out alone
+        self._throttle_until = {}
+
+        # Dedicated pool for image work so it neither competes with the
+        # metadata calls on the default executor nor is capped by its size.
+        # Threads rather than processes: libvips releases the GIL while it
+        # decodes/encodes, and a process pool would pickle every image.
+        self.cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='image')
+        self.buffers = BufferPool()
+
+        # Single writer thread for the parquet storage and the image rows. Jobs
+        # run in submission order, so storage needs no locking, and a flush
+        # (encode + write of up to a shard) never blocks the event loop.
+        self.io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+        self._store_slots = asyncio.Semaphore(MAX_PENDING_STORES)
+
+        if DEDUPLICATE_IMAGES:
+            # Left over from images that were reserved but never stored
+            self.db.clear_hash_reservations()
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(**self._connector_kwargs)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        self.session = None
+
+    async def _fetch(self, session, url, handle, headers=None, retries=5):
+        """
+        GETs url with retries on 429s and connection errors. On a 200/206
+        response, returns the result of `await handle(response)`; None on failure.
+        """
+        loop = asyncio.get_running_loop()
+        host = urlsplit(url).hostname
+
         for attempt in range(retries):
+            delay = self._throttle_until.get(host, 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
             try:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        return await response.read()
+                async with session.get(url, headers=headers) as response:
+                    if response.status in (200, 206):
+                        return await handle(response)
                     elif response.status == 429: # Too Many Requests
-                        wait_time = (2 ** attempt) + 1
-                        logger.warning(f"Rate limited on {url}. Retrying in {wait_time}s...")
+                        retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                        if retry_after is not None:
+                            wait_time = min(retry_after, RETRY_AFTER_MAX_SECONDS)
+                        else:
+                            wait_time = min(2 ** attempt, BACKOFF_MAX_SECONDS)
+                        # Jitter so concurrent downloads don't all retry at once
+                        wait_time += random.random()
+                        logger.warning(f"Rate limited on {url}. Retrying in {wait_time:.1f}s...")
+                        self._throttle_until[host] = max(self._throttle_until.get(host, 0), loop.time() + wait_time)
                         await asyncio.sleep(wait_time)
                     else:
                         logger.warning(f"Failed to download {url}: Status {response.status}")
                         return None
             except Exception as e:
                 if attempt < retries - 1:
-                    wait_time = (2 ** attempt) + 1
-                    logger.warning(f"Error downloading {url}: {e}. Retrying in {wait_time}s...")
+                    wait_time = min(2 ** attempt, BACKOFF_MAX_SECONDS) + random.random()
+                    logger.warning(f"Error downloading {url}: {e}. Retrying in {wait_time:.1f}s...")
                     await asyncio.sleep(wait_time)
                 else:
                     logger.error(f"Failed to download {url} after {retries} attempts: {e}")
                     return None
         return None
 
+    async def download_image(self, session, url, retries=5):
+        """
+        Downloads url into a pooled buffer sized from the response headers.
+        Returns a memoryview over the image bytes, or None on failure; pass it
+        to self.buffers.release() once done with it.
+        """
+        async def read_first(response):
+            if response.status == 206:
+                total = _parse_content_range_total(response.headers.get('Content-Range'))
+                if total is None:
+                    # Missing Content-Range or an unknown total ("bytes 0-N/*"):
+                    # the body is only the first range, not the whole file
+                    return None, 0, None
+            elif 'Content-Encoding' not in response.headers:
+                total = response.content_length
+            else:
+                total = None  # Decoded size differs from Content-Length
+
+            if total is None:
+                body = await response.read()
+                return body, len(body), len(body)
+
+            buffer = self.buffers.acquire(total)
+            try:
+                # Sliced to the expected size so an overrun is caught, not written into the slack
+                received = await _read_into(response, memoryview(buffer)[:total], 0)
+            except BaseException:
+                self.buffers.release(buffer)
+                raise
+            return buffer, received, total
+
+        # Ask for the first chunk only; small files arrive whole, and for large
+        # ones the Content-Range total tells us how many parallel ranges to fetch.
+        result = await self._fetch(session, url, read_first, {'Range': f'bytes=0-{RANGE_CHUNK_SIZE - 1}'}, retries)
+        if result is None:
+            return None
+
+        buffer, received, total = result
+        if buffer is None:
+            # Can't tell how many ranges to fetch, so take the file in one request
+            result = await self._fetch(session, url, read_first, None, retries)
+            if result is None or result[0] is None:
+                logger.warning(f"No usable response size for {url}")
+                return None
+            buffer, received, total = result
+
+        if received >= total:
+            return memoryview(buffer)[:received]
+
+        image = memoryview(buffer)[:total]
+
+        async def read_range(response):
+            # A 200 means the server ignored the Range header and sent the whole file
+            start = 0 if response.status == 200 else _parse_content_range_start(response.headers.get('Content-Range'))
+            return response.status, await _read_into(response, image, start)
+
+        remaining = total - received
+        part_size = max(RANGE_CHUNK_SIZE, -(-remaining // (RANGE_MAX_PARTS - 1)))
+        ranges = [(start, min(start + part_size, total) - 1) for start in range(received, total, part_size)]
+
+        parts = await asyncio.gather(*[
+            self._fetch(session, url, read_range, {'Range': f'bytes={start}-{end}'}, retries)
+            for start, end in ranges
+        ])
+
+        for (start, end), part in zip(ranges, parts):
+            if part is None:
+                self.buffers.release(image)
+                return None
+            status, written_to = part
+            if status == 200 and written_to == total:
+                return image
+            if written_to != end + 1:
+                logger.warning(f"Short range response for {url} (bytes {start}-{end})")
+                self.buffers.release(image)
+                return None
+
+        return image
+
     async def process_post(self, session, post, artist_id):
         post_id = str(post['id'])
-        
-        # Check if post already exists in DB (optional optimization, but hash check is better)
-        # For now, we rely on hash check for deduplication, but we can skip if we know we have this post_id
-        # self.db.cursor.execute("SELECT 1 FROM images WHERE post_id = ?", (post_id,))
-        # if self.db.cursor.fetchone():
-        #     return
+
+        # Posts already stored for this artist were filtered out in scrape_artist
 
         # URL Extraction Logic (Prioritize file_url as requested)
         file_url = post.get('file_url')
@@ -72,122 +295,169 @@ class AsyncScraper:
             logger.warning(f"No image URL found for post {post_id}. Skipping.")
             return
 
-        async with self.semaphore:
-            image_bytes = await self.download_image(session, file_url)
+        image_bytes = await self.download_image(session, file_url)
         
         if not image_bytes:
             logger.warning(f"Download failed for post {post_id} (URL: {file_url})")
             return
 
-        # Process Image (CPU bound, run in executor)
+        # Process Image (CPU bound, run on the image pool)
         loop = asyncio.get_event_loop()
-        compressed_bytes = await loop.run_in_executor(None, process_image_bytes, image_bytes)
+        # Compress and hash in a single job
+        try:
+            compressed_bytes, image_hash = await loop.run_in_executor(self.cpu_pool, process_and_hash, image_bytes)
+        finally:
+            self.buffers.release(image_bytes)
         
         if not compressed_bytes:
             logger.warning(f"Failed to process image for post {post_id} (processing returned None)")
             return
 
-        # Calculate Hash
-        image_hash = await loop.run_in_executor(None, calculate_hash, compressed_bytes)
-        
-        if not image_hash:
-            logger.warning(f"Failed to calculate hash for post {post_id}")
-            return
-
-        # Check Hash Index (Deduplication)
+        # Check Hash Index (Deduplication): one atomic insert-or-skip, so two
+        # posts with the same hash can't both get through. Run off the loop
+        # since it waits on the writer lock.
         if DEDUPLICATE_IMAGES:
-            self.db.cursor.execute("SELECT image_id FROM hash_index WHERE hash = ?", (image_hash,))
-            if self.db.cursor.fetchone():
+            if not await loop.run_in_executor(None, self.db.reserve_hash, image_hash):
                 logger.info(f"Duplicate found for post {post_id} (hash: {image_hash}). Skipping.")
                 return
 
-        # Add to Storage (Buffer)
-        flush_result = self.storage.add_image(compressed_bytes, artist_id, post_id, image_hash)
-        if flush_result is None and len(self.storage.buffer) > 0:
-             # If flush_result is None, it means it was buffered.
-             pass
-        elif flush_result:
-             self._update_db_from_flush(flush_result)
-        
+        # Add to Storage (Buffer) on the writer thread; not awaited, so a flush
+        # there doesn't hold up this task's next download. The slots bound how
+        # many images wait for the writer, so a slow flush pauses downloads
+        # instead of piling compressed images up in memory.
+        await self._store_slots.acquire()
+        future = asyncio.wrap_future(self.io_pool.submit(self._store_image, compressed_bytes, artist_id, post_id, image_hash))
+        future.add_done_callback(self._store_done)
+
+    def _store_done(self, future):
+        # Runs on the event loop once the writer thread is done with the image
+        self._store_slots.release()
+        _log_store_failure(future)
+
+    def _store_image(self, compressed_bytes, artist_id, post_id, image_hash):
+        # Runs on the writer thread
+        flush_results = self.storage.add_image(compressed_bytes, artist_id, post_id, image_hash)
+        if flush_results:
+            self._update_db_from_flush(flush_results)
         logger.info(f"Successfully processed post {post_id}")
 
-    def _update_db_from_flush(self, flush_result):
-        shard_file = flush_result['shard_file']
-        rows = flush_result['rows']
-        start_offset = flush_result.get('start_offset', 0)
-        
-        for i, row in enumerate(rows):
-            try:
-                # Insert into images
-                self.db.cursor.execute("""
-                    INSERT INTO images (artist_id, source, post_id, hash, timestamp, shard_file, offset, size)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (row['artist_id'], row['source'], row['post_id'], row['hash'], row['timestamp'], shard_file, start_offset + i, row['size']))
-                
-                image_id = self.db.cursor.lastrowid
-                
-                # Insert into hash_index (Ignore duplicates if they exist)
-                self.db.cursor.execute("""
-                    INSERT OR IGNORE INTO hash_index (hash, image_id)
-                    VALUES (?, ?)
-                """, (row['hash'], image_id))
-            except sqlite3.IntegrityError as e:
-                logger.warning(f"Integrity error inserting image {row['post_id']} (hash: {row['hash']}): {e}")
-        
-        self.db.conn.commit()
+    def _finish_storage(self):
+        # Final flush; also finishes the shard so the viewer can read it
+        flush_results = self.storage.close()
+        if flush_results:
+            self._update_db_from_flush(flush_results)
+
+    def _finish_storage_if_stale(self):
+        flush_results = self.storage.finish_if_stale()
+        if flush_results:
+            self._update_db_from_flush(flush_results)
+
+    async def finish_storage(self):
+        """Finishes the open shard and records its images (e.g. before idling)."""
+        await asyncio.get_running_loop().run_in_executor(self.io_pool, self._finish_storage)
+
+    def has_unrecorded_images(self):
+        """
+        True while stored images are still waiting for their shard to finish.
+        Only meaningful between scrapes, when the writer thread is idle.
+        """
+        return self.storage.has_unrecorded()
+
+    def _update_db_from_flush(self, flush_results):
+        """Records the images of every shard a flush wrote to, in one transaction."""
+        try:
+            self.db.record_flushes(flush_results)
+        except sqlite3.IntegrityError as e:
+            count = sum(result['count'] for result in flush_results)
+            logger.error(f"Integrity error recording {count} flushed images: {e}")
 
     async def scrape_artist(self, artist_id, artist_name, last_scraped_post=None):
+        if self.session is None:
+            raise RuntimeError("AsyncScraper must be entered with 'async with' before scraping")
+
         logger.info(f"Scraping artist: {artist_name}")
         
-        page = 1
-        posts_count = 0
+        # Metadata pages are fetched by a producer while consumers download and
+        # process posts, so page fetches overlap with image downloads
+        queue = asyncio.Queue(maxsize=PAGE_LIMIT * PAGE_PREFETCH)
         new_last_post = last_scraped_post
+
+        # Posts already stored for this artist, loaded once so re-scrapes skip
+        # them before downloading, without a per-post lookup. Those in the open
+        # shard aren't in the database yet; the writer is idle between scrapes.
+        known_posts = set()
+        if SKIP_EXISTING_POSTS:
+            known_posts = self.db.get_post_ids(artist_id, self.storage.source) | self.storage.unrecorded_post_ids(artist_id)
         
-        async with aiohttp.ClientSession() as session:
+        async def produce():
+            nonlocal new_last_post
+            loop = asyncio.get_running_loop()
+            # Cursor pagination: after the first page, ask for posts below the
+            # lowest id seen ("b<id>"), which stays cheap at any depth and
+            # doesn't shift when new posts are uploaded mid-scrape
+            page = 1
+            first_post = True
             while True:
-                # Fetch metadata (Sync call wrapped in executor if needed, but fast enough)
                 try:
-                    # Increased limit to 100 (max for most boorus) and removed page limit
-                    posts = self.client.post_list(tags=f"{artist_name} -animated", page=page, limit=100)
+                    # pybooru is synchronous; run it in a thread so downloads keep going
+                    posts = await loop.run_in_executor(None, lambda: self.client.post_list(
+                        tags=f"{artist_name} -animated", page=page, limit=PAGE_LIMIT
+                    ))
                     logger.info(f"Page {page}: Fetched {len(posts)} posts for {artist_name}")
                 except Exception as e:
                     logger.error(f"Error fetching posts for {artist_name}: {e}")
-                    break
+                    return
 
                 if not posts:
-                    break
+                    return
 
-                tasks = []
                 for post in posts:
                     post_id = str(post['id'])
                     
                     # Stop if we reached the last scraped post
                     if last_scraped_post and post_id == last_scraped_post:
                         logger.info(f"Reached last scraped post {last_scraped_post}. Stopping.")
-                        # Wait for pending tasks
-                        await asyncio.gather(*tasks)
-                        return new_last_post
+                        return
 
-                    if page == 1 and posts_count == 0:
+                    if first_post:
                         new_last_post = post_id
+                        first_post = False
+
+                    if post_id in known_posts:
+                        continue
+
+                    await queue.put(post)
+
+                page = f"b{min(post['id'] for post in posts)}"
 
-                    tasks.append(self.process_post(session, post, artist_id))
-                    posts_count += 1
+        async def consume(session):
+            while True:
+                post = await queue.get()
+                if post is None:
+                    return
+                try:
+                    await self.process_post(session, post, artist_id)
+                except Exception as e:
+                    logger.error(f"Error processing post {post.get('id')}: {e}")
 
-                await asyncio.gather(*tasks)
-                page += 1
-                
-                # Safety break removed to allow full scraping
-                # if page > 10: 
-                #    break
+        # More consumers than download slots so processing overlaps downloading
+        consumers = [asyncio.create_task(consume(self.session)) for _ in range(self.concurrency_limit * 2)]
+        try:
+            await produce()
+        finally:
+            for _ in consumers:
+                await queue.put(None)
+            await asyncio.gather(*consumers)
 
-        # Final flush
-        flush_result = self.storage.flush()
-        if flush_result:
-            self._update_db_from_flush(flush_result)
+        # Queued behind every pending store, so it runs once they're all
+        # written. The shard stays open for the next artists (one per scrape
+        # would leave many tiny shards) unless it has been open too long.
+        await asyncio.get_running_loop().run_in_executor(self.io_pool, self._finish_storage_if_stale)
             
         return new_last_post
 
     def close(self):
+        self.cpu_pool.shutdown()
+        self.io_pool.shutdown()
+        self._finish_storage()
         self.db.close()
-        self.storage.close()
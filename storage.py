@@ -1,67 +1,121 @@
 import os
-import pandas as pd
+import time
 import pyarrow as pa
 import pyarrow.parquet as pq
 from datetime import datetime
 
 PARQUET_BASE_DIR = os.path.join("hoard", "parquet")
 SHARD_SIZE_LIMIT_MB = 64  # Increased shard size target
+FLUSH_MAX_ROWS = 2048  # Flush after this many buffered images (one full row group)...
+FLUSH_MAX_SECONDS = 60  # ...or once this long has passed since the last flush
+SHARD_MAX_OPEN_SECONDS = 15 * 60  # Shards are finished (and their images recorded) when full or this old
+STALE_PARTIAL_SHARD_SECONDS = 60 * 60  # Unfinished shards untouched this long were left by a crash
+
+# Declared up front so flushes skip type inference and every shard has the same layout
+SHARD_SCHEMA = pa.schema([
+    ("image_bytes", pa.large_binary()),
+    ("artist_id", pa.int64()),
+    ("source", pa.dictionary(pa.int32(), pa.string())),
+    ("post_id", pa.string()),
+    ("hash", pa.string()),
+    ("timestamp", pa.timestamp("us")),
+    ("size", pa.int64()),
+])
+
+# WebP payloads don't compress further, so only the metadata columns get zstd,
+# and only they get min/max statistics (which would otherwise copy image bytes)
+_METADATA_COLUMNS = [name for name in SHARD_SCHEMA.names if name != "image_bytes"]
+WRITER_OPTIONS = dict(
+    compression={**{name: "zstd" for name in _METADATA_COLUMNS}, "image_bytes": "none"},
+    compression_level={name: 3 for name in _METADATA_COLUMNS},
+    use_dictionary=["source", "artist_id"],
+    data_page_size=1 << 20,
+    write_statistics=_METADATA_COLUMNS,
+)
+ROW_GROUP_SIZE = 2048
 
 class ParquetStorage:
-    def __init__(self, source="danbooru"):
+    def __init__(self, source="danbooru", db=None):
         self.source = source
+        self.db = db
         self.buffer = []
         self.seen_hashes = set()
+        self.last_flush = time.monotonic()
+
+        # Each flush appends a row group to the open shard instead of rewriting it
+        self.schema = SHARD_SCHEMA
+        self.writer = None
+        self.shard_rows = 0
+        self.unrecorded_since = None  # When the oldest image not yet in a finished shard was added
+        # Rows written to the open shard, held back until it's finished:
+        # recorded before then, they would point at an unreadable file
+        self.pending_result = None
         
         # Ensure source directory exists
         self.source_dir = os.path.join(PARQUET_BASE_DIR, self.source)
         os.makedirs(self.source_dir, exist_ok=True)
         
+        self._remove_stale_partial_shards()
         self._init_shard_state()
 
     def _init_shard_state(self):
-        # Find the latest shard
-        existing_files = [f for f in os.listdir(self.source_dir) if f.endswith(".parquet")]
-        if not existing_files:
-            self.current_shard_index = 0
-            self.existing_shard_size = 0
-            self.buffer_size_bytes = 0
-            return
+        # A finished parquet file can't be appended to, so always start a new
+        # shard after the latest one. With a database the index is claimed
+        # there when the shard is opened; otherwise it comes from the files.
+        self.current_shard_index = None if self.db else self._next_index_on_disk()
+        self.existing_shard_size = 0
+        self.buffer_size_bytes = 0
 
+    def _remove_stale_partial_shards(self):
+        # A crash or kill leaves the open shard as an unreadable .parquet.tmp.
+        # None of its images were recorded (and their artists' progress was
+        # held back with them), so it's safe to delete once no writer can
+        # still hold it: skip the index last claimed for the source and any
+        # file written to recently.
+        claimed = self.db.get_storage_meta(self.source) if self.db else None
+        live_name = f"shard_{claimed[0]:04d}.parquet.tmp" if claimed else None
+        now = time.time()
+        for entry in os.scandir(self.source_dir):
+            if not entry.name.endswith(".parquet.tmp") or entry.name == live_name:
+                continue
+            if now - entry.stat().st_mtime < STALE_PARTIAL_SHARD_SECONDS:
+                continue
+            os.remove(entry.path)
+            print(f"Removed unfinished shard {entry.path} left by an earlier run")
+
+    def _next_index_on_disk(self):
         indices = []
-        for f in existing_files:
+        for f in os.listdir(self.source_dir):
+            # Unfinished shards (.parquet.tmp, e.g. left by a crash) still hold their index
+            if not f.endswith((".parquet", ".parquet.tmp")):
+                continue
             try:
-                part = f.replace("shard_", "").replace(".parquet", "")
+                part = f.replace("shard_", "").replace(".parquet", "").replace(".tmp", "")
                 indices.append(int(part))
             except ValueError:
                 continue
         
-        if not indices:
-            self.current_shard_index = 0
-            self.existing_shard_size = 0
-            self.buffer_size_bytes = 0
-            return
-
-        max_idx = max(indices)
-        last_shard_path = os.path.join(self.source_dir, f"shard_{max_idx:04d}.parquet")
-        
-        try:
-            size = os.path.getsize(last_shard_path)
-            if size < SHARD_SIZE_LIMIT_MB * 1024 * 1024:
-                # Append to this shard
-                self.current_shard_index = max_idx
-                self.existing_shard_size = size
-                self.buffer_size_bytes = size
-                print(f"Resuming shard {max_idx} ({size/1024/1024:.2f} MB)")
-            else:
-                # Start new shard
-                self.current_shard_index = max_idx + 1
-                self.existing_shard_size = 0
-                self.buffer_size_bytes = 0
-        except OSError:
-             self.current_shard_index = max_idx + 1
-             self.existing_shard_size = 0
-             self.buffer_size_bytes = 0
+        return max(indices) + 1 if indices else 0
+
+    def _open_shard(self):
+        if self.db is not None:
+            # Claimed atomically, so concurrent scrapers never share a shard.
+            # The directory is only scanned once, to seed a source's first claim.
+            first_index = 0 if self.db.get_storage_meta(self.source) else self._next_index_on_disk()
+            self.current_shard_index = self.db.claim_shard(self.source, first_index)
+
+        # Written under a temporary name and renamed when finished, so a
+        # shard at its final path is always complete
+        self.writer = pq.ParquetWriter(self._partial_path(), self.schema, **WRITER_OPTIONS)
+        self.shard_rows = 0
+        if self.unrecorded_since is None:
+            self.unrecorded_since = time.monotonic()
+
+    def _shard_filename(self):
+        return f"shard_{self.current_shard_index:04d}.parquet"
+
+    def _partial_path(self):
+        return os.path.join(self.source_dir, self._shard_filename() + ".tmp")
 
     def add_image(self, image_bytes, artist_id, post_id, image_hash, timestamp=None):
         # if image_hash in self.seen_hashes:
@@ -81,70 +135,139 @@ class ParquetStorage:
         }
         
         self.buffer.append(row)
+        if self.unrecorded_since is None:
+            self.unrecorded_since = time.monotonic()
         self.seen_hashes.add(image_hash)
         self.buffer_size_bytes += len(image_bytes)
 
-        # Check if buffer is full (approximate check)
-        if self.buffer_size_bytes >= SHARD_SIZE_LIMIT_MB * 1024 * 1024:
-            return self.flush()
+        # Flush when the shard would be full (sizes are of the compressed
+        # images), or when the buffer is long or old enough
+        if (self.buffer_size_bytes >= SHARD_SIZE_LIMIT_MB * 1024 * 1024
+                or len(self.buffer) >= FLUSH_MAX_ROWS
+                or time.monotonic() - self.last_flush >= FLUSH_MAX_SECONDS):
+            # These flushes only add row groups to the open shard; its images
+            # are recorded when it finishes, here too once it's old enough,
+            # so a long scrape doesn't keep them hidden until it ends
+            return (self.flush() or []) + self.finish_if_stale()
         
         return None
 
     def flush(self):
+        """
+        Writes the buffer to the open shard, spilling into the next shard once
+        it reaches the size limit. Returns one result per shard this finished
+        (its rows for the database); rows in the still-open shard are returned
+        once it's finished.
+        """
         if not self.buffer:
             return None
 
-        shard_filename = f"shard_{self.current_shard_index:04d}.parquet"
+        rows = self.buffer
+        self.buffer = []
+        self.seen_hashes = set()
+        self.last_flush = time.monotonic()
+
+        results = []
+        while rows:
+            # Take rows until the shard would pass the limit (always at least one)
+            room = SHARD_SIZE_LIMIT_MB * 1024 * 1024 - self.existing_shard_size
+            take, taken_bytes = 1, rows[0]["size"]
+            while take < len(rows) and taken_bytes + rows[take]["size"] <= room:
+                taken_bytes += rows[take]["size"]
+                take += 1
+
+            finished = self._write_rows(rows[:take])
+            rows = rows[take:]
+            if rows and finished is None:
+                finished = self._finish_shard()
+            if finished is not None:
+                results.append(finished)
+
+        self.buffer_size_bytes = self.existing_shard_size
+        return results
+
+    def _write_rows(self, rows):
+        if self.writer is None:
+            self._open_shard()
+        shard_filename = self._shard_filename()
         shard_path = os.path.join(self.source_dir, shard_filename)
 
-        new_df = pd.DataFrame(self.buffer)
-        start_offset = 0
-        
-        # Check if we need to append
-        if os.path.exists(shard_path):
-            try:
-                existing_df = pd.read_parquet(shard_path)
-                start_offset = len(existing_df)
-                final_df = pd.concat([existing_df, new_df], ignore_index=True)
-            except Exception as e:
-                print(f"Error reading existing shard {shard_path}: {e}. Creating new one.")
-                # Fallback: increment index and write new
-                self.current_shard_index += 1
-                shard_filename = f"shard_{self.current_shard_index:04d}.parquet"
-                shard_path = os.path.join(self.source_dir, shard_filename)
-                final_df = new_df
-                start_offset = 0
-        else:
-            final_df = new_df
-
-        table = pa.Table.from_pandas(final_df)
-        pq.write_table(table, shard_path)
+        # Rows -> columns, built straight into the declared types
+        columns = [[row[name] for row in rows] for name in self.schema.names]
+        batch = pa.record_batch(columns, schema=self.schema)
+
+        self.writer.write_batch(batch, row_group_size=ROW_GROUP_SIZE)
+        start_offset = self.shard_rows
+        self.shard_rows += batch.num_rows
         
-        print(f"Flushed {len(self.buffer)} new images to {shard_path} (Total rows: {len(final_df)})")
+        print(f"Flushed {len(rows)} new images to {shard_path} (Total rows: {self.shard_rows})")
 
-        # Return info for database update
+        # Info for the database update, once the shard is finished
         relative_path = os.path.join(self.source, shard_filename).replace("\\", "/")
         
-        result = {
-            "shard_file": relative_path,
-            "count": len(self.buffer),
-            "rows": self.buffer,
-            "start_offset": start_offset
-        }
+        # Update sizes and check if we need to rotate shard
+        self.existing_shard_size = os.path.getsize(self._partial_path())
 
-        self.buffer = []
-        self.seen_hashes = set()
+        if self.pending_result is None:
+            self.pending_result = {
+                "shard_file": relative_path,
+                "source": self.source,
+                "count": 0,
+                "rows": [],
+                "start_offset": start_offset
+            }
+        self.pending_result["count"] += len(rows)
+        self.pending_result["rows"].extend(rows)
         
-        # Update sizes and check if we need to rotate shard
-        self.existing_shard_size = os.path.getsize(shard_path)
-        self.buffer_size_bytes = self.existing_shard_size
+        if self.existing_shard_size >= SHARD_SIZE_LIMIT_MB * 1024 * 1024:
+            return self._finish_shard()
         
-        if self.buffer_size_bytes >= SHARD_SIZE_LIMIT_MB * 1024 * 1024:
+        return None
+
+    def _finish_shard(self):
+        # Writes the parquet footer; the shard is only readable after this.
+        # Returns the rows held back for it.
+        if self.writer is None:
+            return None
+        self.writer.close()
+        self.writer = None
+        os.replace(self._partial_path(), os.path.join(self.source_dir, self._shard_filename()))
+        if self.db is None:
             self.current_shard_index += 1
-            self.existing_shard_size = 0
-            self.buffer_size_bytes = 0
-        
+        self.existing_shard_size = 0
+        self.buffer_size_bytes = 0
+        self.unrecorded_since = None
+
+        result = self.pending_result
+        self.pending_result = None
         return result
 
+    def has_unrecorded(self):
+        """True while some added images are buffered or in a shard that isn't finished."""
+        return bool(self.buffer) or self.writer is not None
+
+    def finish_if_stale(self):
+        """
+        Like close(), but only once the oldest unrecorded image is
+        SHARD_MAX_OPEN_SECONDS old. Lets a shard span several scrapes without
+        its images staying invisible until it fills up.
+        """
+        if self.unrecorded_since is None or time.monotonic() - self.unrecorded_since < SHARD_MAX_OPEN_SECONDS:
+            return []
+        return self.close()
+
+    def unrecorded_post_ids(self, artist_id):
+        """Post ids of artist_id's images that are stored but not recorded yet."""
+        rows = self.buffer + (self.pending_result["rows"] if self.pending_result else [])
+        return {row["post_id"] for row in rows if row["artist_id"] == artist_id}
+
     def close(self):
-        return self.flush()
+        """
+        Flushes the buffer and finishes the open shard so it can be read.
+        The storage stays usable; the next flush starts a new shard.
+        """
+        results = self.flush() or []
+        finished = self._finish_shard()
+        if finished is not None:
+            results.append(finished)
+        return results